@@ -1,64 +1,418 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
-import plotly.express as px
-import requests
-from datetime import datetime, timedelta
+import plotly.graph_objects as go
+import aiohttp
+import asyncio
+import ijson
+import joblib
+import logging
+import orjson
+import threading
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+from datetime import date, datetime, timedelta
+from tsdownsample import LTTBDownsampler
 
 # --- Configuration ---
 st.set_page_config(page_title="SkyCast Analytics", page_icon="🌤️", layout="wide")
 
 # --- Helper Functions ---
-@st.cache_data
-def get_city_coordinates(city_name):
+logger = logging.getLogger(__name__)
+
+# Caps concurrent requests to Open-Meteo across both lookup rounds.
+MAX_CONCURRENT_REQUESTS = 4
+# Pooled connections are kept alive between requests to skip repeat TCP/TLS handshakes.
+MAX_CONNECTIONS = 8
+KEEPALIVE_TIMEOUT = 60
+# Daily series compress well; aiohttp inflates br via the brotli package.
+REQUEST_HEADERS = {"User-Agent": "skycast/1.0", "Accept-Encoding": "gzip, br"}
+
+# On-disk HTTP cache shared across sessions and restarts (skycast.sqlite).
+CACHE_NAME = "skycast"
+CACHE_EXPIRE_AFTER = timedelta(days=7)
+# Archive data older than this many days is final and never needs refetching.
+ARCHIVE_FINAL_AFTER_DAYS = 5
+RECENT_ARCHIVE_EXPIRE_AFTER = timedelta(hours=1)
+NEVER_EXPIRE = -1
+# Archive ranges at least this long are stream-parsed instead of decoded in one go.
+STREAM_MIN_DAYS = 5 * 365
+
+# Geocoding results keyed on normalized city name, kept on disk across redeploys.
+GEOCODE_CACHE_DIR = "./.skycast_cache"
+_GEOCODE_MEMORY = joblib.Memory(GEOCODE_CACHE_DIR, verbose=0)
+# Most recent geocoding results also held in process memory, shared across reruns.
+GEOCODE_MEMO_SIZE = 4096
+
+# Custom Colors: Neon Blue & Sunset Orange
+CITY_COLORS = ("#00E5FF", "#FF4500")
+# Fixed line-chart layout, built once at import; only the title varies per comparison.
+LINE_CHART_LAYOUT = {
+    "xaxis": {"title": {"text": "Date"}, "type": "date"},
+    "yaxis": {"title": {"text": "Temperature (°C)"}},
+    "legend": {"title": {"text": "City"}},
+    "hovermode": "x unified",
+}
+# Above this many plotted points the chart switches from SVG to WebGL traces.
+WEBGL_MIN_POINTS = 1000
+# Each city's series is downsampled to at most this many points before plotting.
+MAX_PLOT_POINTS = 2000
+# Above this many daily points (both cities) the chart becomes a weekly heatmap,
+# since per-day markers only overlap into a blob at that density.
+HEATMAP_MIN_POINTS = 5000
+# Built figures are shared by all sessions; keep only the most recent ones, briefly.
+FIGURE_CACHE_MAX_ENTRIES = 32
+FIGURE_CACHE_TTL = timedelta(hours=1)
+
+def _cached_session():
+    """
+    Creates a keep-alive aiohttp session backed by the persistent SQLite response cache.
+    Must be called on the event loop the session will be used from.
+    """
+    cache = SQLiteBackend(
+        cache_name=CACHE_NAME,
+        expire_after=CACHE_EXPIRE_AFTER,
+        allowed_methods=("GET",),
+    )
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=KEEPALIVE_TIMEOUT)
+    return CachedSession(cache=cache, connector=connector, headers=REQUEST_HEADERS)
+
+@st.cache_resource
+def _event_loop():
+    """
+    Starts a background event loop that lives as long as the server process, so the
+    shared session and its pooled connections outlast individual reruns.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="skycast-http", daemon=True).start()
+    return loop
+
+async def _open_session():
+    """
+    Opens the shared session from inside the background event loop.
+    """
+    return _cached_session()
+
+@st.cache_resource
+def _shared_session():
+    """
+    Returns the process-wide HTTP session, created on the background event loop.
+    """
+    return asyncio.run_coroutine_threadsafe(_open_session(), _event_loop()).result()
+
+async def _fetch_json(session, semaphore, url, params, expire_after=None):
+    """
+    Performs a GET request and returns the decoded JSON body.
+    """
+    async with semaphore:
+        async with session.get(url, params=params, expire_after=expire_after) as response:
+            response.raise_for_status()
+            logger.debug("GET %s content-encoding=%s", response.url, response.headers.get("Content-Encoding"))
+            # orjson parses the raw bytes directly, skipping the decode-to-str step
+            return orjson.loads(await response.read())
+
+async def _stream_daily_series(session, semaphore, url, params, n_days, expire_after=None):
+    """
+    Performs a GET request against the archive API and stream-parses each location's
+    daily temperatures into a pre-sized array, never building the decoded JSON document.
+    Returns one temperature array per location, or None where "daily" is missing.
+    """
+    series = []
+    async with semaphore:
+        async with session.get(url, params=params, expire_after=expire_after) as response:
+            response.raise_for_status()
+            logger.debug("GET %s content-encoding=%s", response.url, response.headers.get("Content-Encoding"))
+            async for prefix, event, value in ijson.parse(response.content, use_float=True):
+                # Several locations arrive as a top-level list, a single one as a bare object
+                path = prefix[len("item."):] if prefix.startswith("item.") else prefix
+                if event == "start_map" and path in ("", "item"):
+                    series.append(None)
+                elif event == "start_map" and path == "daily":
+                    temps = np.empty(n_days, dtype=np.float32)
+                    n_temps = 0
+                elif path == "daily.temperature_2m_max.item":
+                    if n_temps == n_days:
+                        raise ValueError(f"Expected {n_days} daily values, got more")
+                    temps[n_temps] = np.nan if value is None else value
+                    n_temps += 1
+                elif event == "end_map" and path == "daily":
+                    if n_temps != n_days:
+                        raise ValueError(f"Expected {n_days} daily values, got {n_temps}")
+                    series[-1] = temps
+    return series
+
+def _temperature_array(values, n_days):
+    """
+    Copies a decoded temperature list into a pre-sized float32 array; nulls become NaN.
+    """
+    if len(values) != n_days:
+        raise ValueError(f"Expected {n_days} daily values, got {len(values)}")
+    temps = np.empty(n_days, dtype=np.float32)
+    temps[:] = values
+    return temps
+
+@_GEOCODE_MEMORY.cache(ignore=["location"])
+def _geocode_record(normalized_name, location=None):
+    """
+    Disk store for resolved geocoding results. The first call for a name records
+    `location`; later calls return the recorded value.
+    """
+    return location
+
+@st.cache_resource
+def _geocode_memo():
+    """
+    In-memory LRU layer over the disk store, held for the life of the server process.
+    """
+    return {}
+
+async def get_city_coordinates(session, semaphore, memo, city_name):
     """
     Fetches coordinates (lat, lon) for a given city name using Open-Meteo Geocoding API.
     """
-    if not city_name:
+    # " London ", "london" and "LONDON" share one cache entry
+    normalized = " ".join(city_name.strip().lower().split()) if city_name else ""
+    if not normalized:
         return None
-    url = "https://geocoding-api.open-meteo.com/v1/search"
-    params = {"name": city_name, "count": 1, "language": "en", "format": "json"}
-    try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        data = response.json()
+    if normalized in memo:
+        # Re-insert on a hit so the dict's order stays least- to most-recently used
+        memo[normalized] = memo.pop(normalized)
+        return memo[normalized]
+    # The joblib store does blocking disk I/O, so keep it off the shared event loop
+    if await asyncio.to_thread(_geocode_record.check_call_in_cache, normalized):
+        location = await asyncio.to_thread(_geocode_record, normalized)
+    else:
+        url = "https://geocoding-api.open-meteo.com/v1/search"
+        params = {"name": normalized, "count": 1, "language": "en", "format": "json"}
+        # Failed lookups raise here, so they are never recorded
+        data = await _fetch_json(session, semaphore, url, params)
         if "results" in data and data["results"]:
-            return data["results"][0]
+            location = data["results"][0]
         else:
+            # Misses are not memoized, so an empty or degraded response is retried
+            # once the HTTP cache entry expires
             return None
-    except Exception as e:
-        st.error(f"Error fetching coordinates for {city_name}: {e}")
-        return None
+        await asyncio.to_thread(_geocode_record, normalized, location)
+    if len(memo) >= GEOCODE_MEMO_SIZE:
+        # Evict the least recently used entry
+        memo.pop(next(iter(memo)), None)
+    memo[normalized] = location
+    return location
 
-@st.cache_data
-def get_historical_weather(lat, lon, start_date, end_date):
+async def fetch_weather_batch(session, semaphore, coords, start_date, end_date):
     """
-    Fetches historical daily max temperature from Open-Meteo Archive API.
+    Fetches historical daily max temperature for several (lat, lon) pairs from
+    Open-Meteo Archive API in a single request. Returns one DataFrame per pair.
     """
     url = "https://archive-api.open-meteo.com/v1/archive"
     params = {
-        "latitude": lat,
-        "longitude": lon,
+        "latitude": ",".join(str(lat) for lat, _ in coords),
+        "longitude": ",".join(str(lon) for _, lon in coords),
         "start_date": start_date.strftime("%Y-%m-%d"),
         "end_date": end_date.strftime("%Y-%m-%d"),
         "daily": "temperature_2m_max",
         "timezone": "auto"
     }
-    try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        data = response.json()
-        if "daily" in data:
-            df = pd.DataFrame({
-                "Date": data["daily"]["time"],
-                "Max Temp (°C)": data["daily"]["temperature_2m_max"]
-            })
-            df["Date"] = pd.to_datetime(df["Date"])
-            return df
+    # Past days are immutable; only ranges touching recent days can still change.
+    if end_date < date.today() - timedelta(days=ARCHIVE_FINAL_AFTER_DAYS):
+        expire_after = NEVER_EXPIRE
+    else:
+        expire_after = RECENT_ARCHIVE_EXPIRE_AFTER
+    # The archive returns exactly one value per day, so the dates never need parsing
+    n_days = (end_date - start_date).days + 1
+    dates = np.arange(
+        np.datetime64(start_date), np.datetime64(end_date) + np.timedelta64(1, "D"), dtype="datetime64[D]"
+    )
+    if n_days >= STREAM_MIN_DAYS:
+        series = await _stream_daily_series(
+            session, semaphore, url, params, n_days, expire_after=expire_after
+        )
+    else:
+        data = await _fetch_json(session, semaphore, url, params, expire_after=expire_after)
+        # A single location comes back as an object, several as a list.
+        if isinstance(data, dict):
+            data = [data]
+        series = [
+            _temperature_array(loc["daily"]["temperature_2m_max"], n_days) if "daily" in loc else None
+            for loc in data
+        ]
+    # Typed arrays skip pandas' dtype inference
+    frames = []
+    for temps in series:
+        if temps is not None:
+            frames.append(pd.DataFrame({"Date": dates, "Max Temp (°C)": temps}))
         else:
-            return pd.DataFrame()
+            frames.append(pd.DataFrame())
+    return frames
+
+def coordinate_key(coords):
+    """
+    Rounds a geocoding result to ~100 m so near-identical locations compare equal.
+    """
+    return (round(coords["latitude"], 3), round(coords["longitude"], 3))
+
+async def _fetch_comparison(session, memo, city_a, city_b, start_date, end_date):
+    """
+    Geocodes both cities in parallel, then fetches both weather series in one request.
+    Runs on the background loop, so failures are returned as messages in `errors`
+    for the script thread to display.
+    """
+    errors = []
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    results = await asyncio.gather(
+        get_city_coordinates(session, semaphore, memo, city_a),
+        get_city_coordinates(session, semaphore, memo, city_b),
+        return_exceptions=True,
+    )
+    coords_a, coords_b = results
+    for city_name, result in zip((city_a, city_b), results):
+        if isinstance(result, Exception):
+            errors.append(f"Error fetching coordinates for {city_name}: {result}")
+    if isinstance(coords_a, Exception):
+        coords_a = None
+    if isinstance(coords_b, Exception):
+        coords_b = None
+    if not (coords_a and coords_b):
+        return coords_a, coords_b, None, None, errors
+
+    # Two names for one place (e.g. "NYC" and "New York") need only one series
+    same_location = coordinate_key(coords_a) == coordinate_key(coords_b)
+    locations = [(coords_a["latitude"], coords_a["longitude"])]
+    if not same_location:
+        locations.append((coords_b["latitude"], coords_b["longitude"]))
+    try:
+        frames = await fetch_weather_batch(session, semaphore, locations, start_date, end_date)
     except Exception as e:
-        st.error(f"Error fetching weather data: {e}")
-        return pd.DataFrame()
+        errors.append(f"Error fetching weather data: {e}")
+        frames = [pd.DataFrame() for _ in locations]
+    df_a = frames[0]
+    df_b = df_a.copy() if same_location else frames[1]
+    return coords_a, coords_b, df_a, df_b, errors
+
+def downsample_for_plot(df, n_out=MAX_PLOT_POINTS):
+    """
+    Reduces a weather series to at most n_out points with LTTB, keeping the visual shape.
+    """
+    if len(df) <= n_out:
+        return df
+    idx = LTTBDownsampler().downsample(df["Date"].values, df["Max Temp (°C)"].values, n_out=n_out)
+    return df.iloc[idx]
+
+def _distinct_labels(city_a, city_b):
+    """
+    Returns display labels for both cities, tagged A/B when the names are identical.
+    """
+    if city_a == city_b:
+        return f"{city_a} (A)", f"{city_b} (B)"
+    return city_a, city_b
+
+def _build_weekly_heatmap(df_a, df_b, city_a, city_b):
+    """
+    Builds a city-by-week heatmap of mean max temperature for long ranges.
+    """
+    weekly = [
+        df.resample("W-MON", on="Date", closed="left", label="left")["Max Temp (°C)"].mean()
+        for df in (df_a, df_b)
+    ]
+    fig = go.Figure(go.Heatmap(
+        x=weekly[0].index.values,
+        y=list(_distinct_labels(city_a, city_b)),
+        z=np.vstack([weekly[0].values, weekly[1].values]),
+        colorscale="RdYlBu_r",
+        colorbar_title="°C",
+        hovertemplate="%{y}<br>Week of %{x|%Y-%m-%d}<br>%{z:.1f}°C<extra></extra>"
+    ))
+    fig.update_layout(
+        title=f"Weekly Mean Max Temperature: {city_a} vs {city_b}",
+        xaxis_title="Week",
+        yaxis_title="City"
+    )
+    return fig
+
+def build_comparison_table(df_a, df_b, city_a, city_b):
+    """
+    Joins both series on Date into one wide table with a temperature column per city.
+    """
+    city_a, city_b = _distinct_labels(city_a, city_b)
+    return pd.merge(
+        df_a.rename(columns={"Max Temp (°C)": f"{city_a} Max Temp (°C)"}),
+        df_b.rename(columns={"Max Temp (°C)": f"{city_b} Max Temp (°C)"}),
+        on="Date",
+        how="outer",
+        validate="one_to_one",
+        sort=True,
+    )
+
+@st.cache_resource(max_entries=FIGURE_CACHE_MAX_ENTRIES, ttl=FIGURE_CACHE_TTL)
+def build_figure(df_a, df_b, city_a, city_b):
+    """
+    Builds the comparison chart, one trace per city. Held as a shared resource so
+    reruns with the same data reuse the figure instead of rebuilding it.
+    """
+    if len(df_a) + len(df_b) > HEATMAP_MIN_POINTS:
+        return _build_weekly_heatmap(df_a, df_b, city_a, city_b)
+
+    plot_a = downsample_for_plot(df_a)
+    plot_b = downsample_for_plot(df_b)
+    # SVG keeps markers crisp for short ranges; WebGL scales to long ones.
+    trace_type = go.Scattergl if len(plot_a) + len(plot_b) > WEBGL_MIN_POINTS else go.Scatter
+
+    label_a, label_b = _distinct_labels(city_a, city_b)
+    # One trace per city straight from its arrays, no long-format reshape
+    return go.Figure(
+        data=[
+            trace_type(
+                x=df_plot["Date"].values,
+                y=df_plot["Max Temp (°C)"].values,
+                name=city,
+                mode="lines+markers",
+                line={"color": color}
+            )
+            for city, df_plot, color in ((label_a, plot_a, CITY_COLORS[0]), (label_b, plot_b, CITY_COLORS[1]))
+        ],
+        layout=LINE_CHART_LAYOUT | {"title": {"text": f"Max Daily Temperature: {city_a} vs {city_b}"}}
+    )
+
+@st.cache_data(ttl=RECENT_ARCHIVE_EXPIRE_AFTER)
+def run_all(city_a, city_b, start_date, end_date):
+    """
+    Returns (coords_a, coords_b, df_a, df_b) for a comparison.
+    The DataFrames are None when either city could not be geocoded.
+    Held no longer than recent archive responses, so ranges ending near today pick
+    up newly published days and a failed fetch is retried.
+    """
+    future = asyncio.run_coroutine_threadsafe(
+        _fetch_comparison(_shared_session(), _geocode_memo(), city_a, city_b, start_date, end_date),
+        _event_loop(),
+    )
+    coords_a, coords_b, df_a, df_b, errors = future.result()
+    for message in errors:
+        st.error(message)
+    return coords_a, coords_b, df_a, df_b
+
+@st.fragment
+def show_comparison_view(df_a, df_b, city_a, city_b, start_date, end_date):
+    """
+    Renders the chart or the data table, whichever is selected. Unlike st.tabs, only
+    the selected view is sent to the browser, and switching views reruns just this
+    fragment with the same data.
+    """
+    view = st.radio(
+        "View",
+        ["📈 Chart", "📄 Data Table"],
+        horizontal=True,
+        label_visibility="collapsed"
+    )
+    
+    if view == "📈 Chart":
+        fig = build_figure(df_a, df_b, city_a, city_b)
+        st.plotly_chart(fig, use_container_width=True)
+    else:
+        # Merge once per comparison; switching back and forth reuses the stored table
+        table_key = (city_a, city_b, start_date, end_date)
+        if st.session_state.get("table_key") != table_key:
+            st.session_state["table"] = build_comparison_table(df_a, df_b, city_a, city_b)
+            st.session_state["table_key"] = table_key
+        st.dataframe(st.session_state["table"], use_container_width=True)
 
 # --- UI Layout ---
 st.title("SkyCast Analytics 🌤️")
@@ -84,15 +438,12 @@ if len(date_range) == 2:
     
     if st.button("Generate Comparison", type="primary"):
         with st.spinner("Fetching data..."):
-            # Fetch coordinates
-            coords_a = get_city_coordinates(city_a)
-            coords_b = get_city_coordinates(city_b)
+            # Fetch coordinates and weather data
+            coords_a, coords_b, df_a, df_b = run_all(city_a, city_b, start_date, end_date)
             
             if coords_a and coords_b:
-                # Fetch weather data
-                df_a = get_historical_weather(coords_a["latitude"], coords_a["longitude"], start_date, end_date)
-                df_b = get_historical_weather(coords_b["latitude"], coords_b["longitude"], start_date, end_date)
-                
+                if coordinate_key(coords_a) == coordinate_key(coords_b):
+                    st.info("Both cities resolved to the same coordinates.")
                 if not df_a.empty and not df_b.empty:
                     # Calculate Metrics
                     avg_a = df_a["Max Temp (°C)"].mean()
@@ -105,37 +456,8 @@ if len(date_range) == 2:
                     m_col2.metric(f"📍 {city_b} Avg Max Temp", f"{avg_b:.1f}°C")
                     st.divider()
 
-                    # Combine data
-                    df_a["City"] = city_a
-                    df_b["City"] = city_b
-                    df_combined = pd.concat([df_a, df_b])
-                    
-                    # Visualization Tab
-                    tab1, tab2 = st.tabs(["📈 Chart", "📄 Data Table"])
-                    
-                    with tab1:
-                        # Custom Colors: Neon Blue & Sunset Orange
-                        color_map = {city_a: "#00E5FF", city_b: "#FF4500"}
-                        
-                        fig = px.line(
-                            df_combined, 
-                            x="Date", 
-                            y="Max Temp (°C)", 
-                            color="City",
-                            title=f"Max Daily Temperature: {city_a} vs {city_b}",
-                            markers=True,
-                            color_discrete_map=color_map
-                        )
-                        fig.update_layout(
-                            xaxis_title="Date", 
-                            yaxis_title="Temperature (°C)",
-                            legend_title="City",
-                            hovermode="x unified"
-                        )
-                        st.plotly_chart(fig, use_container_width=True)
-                    
-                    with tab2:
-                        st.dataframe(df_combined, use_container_width=True)
+                    # Visualization View
+                    show_comparison_view(df_a, df_b, city_a, city_b, start_date, end_date)
                 else:
                     st.warning("No weather data found for the selected range.")
             else: